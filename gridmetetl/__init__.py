@@ -6,4 +6,9 @@ __version__ = '0.1.0'
 
 from .etl import FpoNHM
 from .helper import np_get_wval
+from .helper import np_get_wvals
+from .helper import get_wght_matrix
+from .helper import read_wghts
+from .helper import pack_int16
 from .helper import get_gm_url
+from .helper import get_day_join
@@ -2,16 +2,30 @@
 import geopandas
 import pandas as pd
 from netCDF4 import default_fillvals, Dataset
-from numpy import arange, dtype, float32, zeros, asarray
+from numpy import arange, dtype, float32
+import os
 import sys
 import xarray as xr
-from helper import get_gm_url, np_get_wval, getaverage
+from helper import VAR_META, get_gm_url, get_day_join, read_wghts, get_wght_matrix, np_get_wvals, pack_int16
 import requests
+from requests.adapters import HTTPAdapter
 from requests.exceptions import HTTPError
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
+from time import perf_counter
 from pathlib import Path
+from tempfile import TemporaryDirectory
 import numpy as np
-import netCDF4
+
+
+# Days mapped and written at a time, also the time chunk size of the output netcdf vars
+NDAYS_CHUNK = 365
+
+# Mapped climate data larger than this (bytes) is stored in memory mapped files
+MEMMAP_NBYTES = 4 * 2**30
+
+# Memory budget (bytes) for the blocks of gridmet data mapped concurrently
+MAP_NBYTES = 8 * 2**30
 
 
 class FpoNHM:
@@ -39,15 +53,6 @@ class FpoNHM:
         """
         self.wghts_id = None
         self.climsource = climsource
-        if climsource == 'GridMetSS':
-            self.gmss_vars = {
-                'tmax': 'daily_maximum_temperature',
-                'tmin': 'daily_minimum_temperature',
-                'ppt': 'precipitation_amount',
-                'rhmax': 'daily_maximum_relative_humidity',
-                'rhmin': 'daily_minimum_relative_humidity',
-                'ws': 'daily_mean_wind_speed',
-                'srad': 'daily_mean_shortwave_radiation_at_surface'}
         self.partial = False
         self.vars = ['tmax', 'tmin', 'ppt', 'rhmax', 'rhmin', 'ws']
 
@@ -60,14 +65,7 @@ class FpoNHM:
         # prefix for file names - default is ''.
         self.fileprefix = None
 
-        # xarray containers for tempurature max, temperature min and precipitation
-        self.dstmax = None
-        self.dstmin = None
-        self.dsppt = None
-        self.dsrhmax = None
-        self.dsrhmin = None
-        self.dsws = None
-        self.dssrad = None
+        # xarray container for the downloaded climate variables
         self.ds = None
 
         # Geopandas dataframe that will hold hru id and geometry
@@ -107,17 +105,10 @@ class FpoNHM:
         # num HRUs
         self.num_hru = None
 
-        # grouby hru_id_nat on wieghts file
-        self.unique_hru_ids = None
-
-        # numpy arrays to store mapped climate data
-        self.np_tmax = None
-        self.np_tmin = None
-        self.np_ppt = None
-        self.np_rhmax = None
-        self.np_rhmin = None
-        self.np_ws = None
-        self.np_srad = None
+        # numpy arrays, keyed by var, to store mapped climate data
+        self.np_arrays = None
+        # temporary directory of the files backing np_arrays when they are memory mapped
+        self.np_tmpdir = None
 
         # logical use_date
         self.use_date = False
@@ -125,22 +116,15 @@ class FpoNHM:
         # Starting date based on numdays
         self.str_start = None
 
-        self.dstmax = None
-        self.dstmin = None
-        self.dsrhmax = None
-        self.dsrhmin = None
-        self.dsws = None
-        self.dssrad = None
-        self.dsppt = None
-
-    def write_extract_file(self, ivar, incfile, url, params):
-        file = requests.get(url, params=params)
-        file.raise_for_status()
+    def write_extract_file(self, session, ivar, url, params):
         tfile = self.iptpath / (self.fileprefix + ivar + (self.end_date.strftime('%Y_%m_%d')) + '.nc')
-        incfile.append(tfile)
-        with open(tfile, 'wb') as fh:
-            fh.write(file.content)
-        fh.close()
+        # stream the response to disk rather than holding the whole file in memory
+        with session.get(url, params=params, stream=True, timeout=300) as file:
+            file.raise_for_status()
+            with open(tfile, 'wb') as fh:
+                for chunk in file.iter_content(chunk_size=1 << 20):
+                    fh.write(chunk)
+        return tfile
 
     def initialize(self, partial, ivars, iptpath, optpath, weights_file, etype=None, days=None,
                    start_date=None, end_date=None, fileprefix=''):
@@ -209,76 +193,69 @@ class FpoNHM:
         if self.type == 'date':
             self.numdays = ((self.end_date - self.start_date).days + 1)
 
-        # Download netcdf subsetted data
-        ncfile = []
+        # variables stored in the same aggregate are retrieved with a single request
+        gm_groups = {}
         for var in self.vars:
-            try:
-                if var == 'tmax':
-                    # Maximum Temperature
-                    self.str_start, url, params = get_gm_url(self.type, 'tmax', self.numdays,
-                                                             self.start_date, self.end_date)
-                    self.write_extract_file(var, ncfile, url, params)
-                    self.dstmax = xr.open_dataset(ncfile[-1], mask_and_scale=True)
-                    self.dstmax = xr.where(self.dstmax < 1000.0, self.dstmax, np.nan)
-                elif var == 'tmin':
-                    # Minimum Temperature
-                    self.str_start, url, params = get_gm_url(self.type, 'tmin', self.numdays,
-                                                             self.start_date, self.end_date)
-                    self.write_extract_file(var, ncfile, url, params)
-                    self.dstmin = xr.open_dataset(ncfile[-1], mask_and_scale=True)
-                    self.dstmin = xr.where(self.dstmin < 1000.0, self.dstmin, np.nan)
-                elif var == 'ppt':
-                    # Precipitation
-                    self.str_start, url, params = get_gm_url(self.type, 'ppt', self.numdays,
-                                                             self.start_date, self.end_date)
-                    self.write_extract_file(var, ncfile, url, params)
-                    self.dsppt = xr.open_dataset(ncfile[-1], mask_and_scale=True)
-                    self.dsppt = xr.where(self.dsppt < 1000.0, self.dsppt, np.nan)
-                elif var == 'rhmax':
-                    # Maximum Relative Humidity
-                    self.str_start, url, params = get_gm_url(self.type, 'rhmax', self.numdays,
-                                                             self.start_date, self.end_date)
-                    self.write_extract_file(var, ncfile, url, params)
-                    self.dsrhmax = xr.open_dataset(ncfile[-1], mask_and_scale=True)
-                    self.dsrhmax = xr.where(self.dsrhmax < 1000.0, self.dsrhmax, np.nan)
-                elif var == 'rhmin':
-                    # Minimum Relative Humidity
-                    self.str_start, url, params = get_gm_url(self.type, 'rhmin', self.numdays,
-                                                             self.start_date, self.end_date)
-                    self.write_extract_file(var, ncfile, url, params)
-                    self.dsrhmin = xr.open_dataset(ncfile[-1], mask_and_scale=True)
-                    self.dsrhmin = xr.where(self.dsrhmin < 1000.0, self.dsrhmin, np.nan)
-                elif var == 'ws':
-                    # Mean daily Wind Speed
-                    self.str_start, url, params = get_gm_url(self.type, 'ws', self.numdays,
-                                                             self.start_date, self.end_date)
-                    self.write_extract_file(var, ncfile, url, params)
-                    self.dsws = xr.open_dataset(ncfile[-1], mask_and_scale=True)
-                    self.dsws = xr.where(self.dsws < 1000.0, self.dsws, np.nan)
-                elif var == 'srad':
-                    # Surface downwelling shortwave flux in air
-                    self.str_start, url, params = get_gm_url(self.type, 'srad', self.numdays,
-                                                             self.start_date, self.end_date)
-                    self.write_extract_file(var, ncfile, url, params)
-                    self.dssrad = xr.open_dataset(ncfile[-1], mask_and_scale=True)
-                    self.dssrad = xr.where(self.dssrad < 1000.0, self.dssrad, np.nan)
-            except HTTPError as http_err:
-                print(f'HTTP error occured: {http_err}', flush=True)
-                if self.numdays == 1:
-                    sys.exit("numdays == 1: Gridmet not updated - EXITING")
-                else:
-                    sys.exit("GridMet not available or a bad request - EXITING")
-            except Exception as err:
-                sys.exit(f'Other error occured: {err}')
-            else:
-                print(f'Gridmet variable {var} retrieved: {ncfile[-1]}', flush=True)
-        # self.ds = xr.open_mfdataset(ncfile, combine='by_coords')
-
-        self.lat_h = self.dstmax['lat']
-        self.lon_h = self.dstmax['lon']
-        self.time_h = self.dstmax['day']
-
-        ts = self.dstmax.sizes
+            gm_groups.setdefault(VAR_META[var]['url'], []).append(var)
+        jobs = []
+        for tvars in gm_groups.values():
+            self.str_start, url, params = get_gm_url(self.type, tvars, self.numdays,
+                                                     self.start_date, self.end_date)
+            jobs.append(('_'.join(tvars), url, params))
+
+        # Download netcdf subsetted data, the variables are retrieved concurrently
+        ncfile = []
+        with requests.Session() as session:
+            adapter = HTTPAdapter(pool_connections=8, pool_maxsize=8)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            with ThreadPoolExecutor(max_workers=len(jobs)) as executor:
+                futures = {executor.submit(self.write_extract_file, session, var, url, params): var
+                           for var, url, params in jobs}
+                for future in as_completed(futures):
+                    var = futures[future]
+                    try:
+                        ncfile.append(future.result())
+                    except HTTPError as http_err:
+                        print(f'HTTP error occured: {http_err}', flush=True)
+                        if self.numdays == 1:
+                            sys.exit("numdays == 1: Gridmet not updated - EXITING")
+                        else:
+                            sys.exit("GridMet not available or a bad request - EXITING")
+                    except Exception as err:
+                        sys.exit(f'Other error occured: {err}')
+                    else:
+                        print(f'Gridmet variable {var} retrieved: {ncfile[-1]}', flush=True)
+
+        # Each file holds different variables on the same grid, if some files are short the days
+        # common to all files are used and the day check below reports the missing days.
+        days = []
+        for tfile in ncfile:
+            with xr.open_dataset(tfile) as tds:
+                days.append(tds['day'].values)
+        try:
+            join = get_day_join(days)
+        except ValueError:
+            tstart = {Path(tfile).name: str(tday[0]) if len(tday) else None for tfile, tday in zip(ncfile, days)}
+            print(f'Gridmet variables start on different days: {tstart}', flush=True)
+            sys.exit("GridMet not available or a bad request - EXITING")
+        if join == 'inner':
+            tlen = {Path(tfile).name: len(tday) for tfile, tday in zip(ncfile, days)}
+            print(f'Gridmet variables returned different days: {tlen}', flush=True)
+            join = 'inner'
+
+        # Open the files concurrently with dask.  Variables are chunked by NDAYS_CHUNK days, the
+        # blocks run_weights maps, so a block only reads and masks its own days.
+        self.ds = xr.open_mfdataset(ncfile, combine='nested', concat_dim=None, compat='override',
+                                    join=join, parallel=True,
+                                    chunks={'day': NDAYS_CHUNK, 'lat': -1, 'lon': -1})
+        self.ds = xr.where(self.ds < 1000.0, self.ds, np.nan)
+
+        self.lat_h = self.ds['lat']
+        self.lon_h = self.ds['lon']
+        self.time_h = self.ds['day']
+
+        ts = self.ds.sizes
         self.dayshape = ts['day']
         self.lonshape = ts['lon']
         self.latshape = ts['lat']
@@ -294,137 +271,59 @@ class FpoNHM:
     def run_weights(self):
 
         # read the weights file
-        d_tmax = d_tmin = d_ppt = d_rhmax = d_rhmin = d_ws = d_srad = None
-        d_flt_tmax = d_flt_tmin = d_flt_ppt = None
-        d_flt_rhmin = d_flt_rhmax = d_flt_ws = d_flt_srad = None
-
-        wght_uofi = pd.read_csv(self.wghts_file)
-        # grab the hru_id from the weights file and use as identifier below
-        self.wghts_id = wght_uofi.columns[1]
+        self.wghts_id, hru_ids, grid_ids, wghts = read_wghts(self.wghts_file)
 
         # this geodataframe merges all hru-ids dissolves so the length of the index
         # equals the number of hrus
         self.gdf1 = self.gdf.sort_values(self.wghts_id).dissolve(by=self.wghts_id)
         self.num_hru = len(self.gdf1.index)
 
-        # group by the weights_id for processing
-        self.unique_hru_ids = wght_uofi.groupby(self.wghts_id)
+        # sparse (num_hru, num_cells) weights matrix, row i holds the normalized weights of
+        # the gridmet cells intersecting the hru at position i of self.gdf1.index
+        wmat = get_wght_matrix(np.asarray(self.gdf1.index), hru_ids, grid_ids, wghts,
+                               self.latshape * self.lonshape)
 
         print('finished reading weight file', flush=True)
 
-        # intialize numpy arrays to store climate vars
-        self.np_tmax = zeros((self.numdays, self.num_hru))
-        self.np_tmin = zeros((self.numdays, self.num_hru))
-        self.np_ppt = zeros((self.numdays, self.num_hru))
-        self.np_rhmax = zeros((self.numdays, self.num_hru))
-        self.np_rhmin = zeros((self.numdays, self.num_hru))
-        self.np_ws = zeros((self.numdays, self.num_hru))
-        self.np_srad = zeros((self.numdays, self.num_hru))
-
-        tindex = asarray(self.gdf1.index, dtype=np.int)
-
-        for day in arange(self.numdays):
-            print(f'Processing day: {day}', flush=True)
-
-            d_tmax = zeros(self.num_hru)
-            d_flt_tmax = self.dstmax[self.gmss_vars['tmax']].values[day, :, :].flatten(order='K')
-
-            d_tmin = zeros(self.num_hru)
-            d_flt_tmin = self.dstmin[self.gmss_vars['tmin']].values[day, :, :].flatten(order='K')
-
-            d_ppt = zeros(self.num_hru)
-            d_flt_ppt = self.dsppt[self.gmss_vars['ppt']].values[day, :, :].flatten(order='K')
-
-            d_rhmax = zeros(self.num_hru)
-            d_flt_rhmax = self.dsrhmax[self.gmss_vars['rhmax']].values[day, :, :].flatten(order='K')
-
-            d_rhmin = zeros(self.num_hru)
-            d_flt_rhmin = self.dsrhmin[self.gmss_vars['rhmin']].values[day, :, :].flatten(order='K')
-
-            d_ws = zeros(self.num_hru)
-            d_flt_ws = self.dsws[self.gmss_vars['ws']].values[day, :, :].flatten(order='K')
-
-            if 'srad' in self.vars:
-                d_srad = zeros(self.num_hru)
-                d_flt_srad = self.dssrad[self.gmss_vars['srad']].values[day, :, :].flatten(order='K')
-
-            for i in arange(len(tindex)):
-                if not self.partial:
-                    weight_id_rows = self.unique_hru_ids.get_group(tindex[i])
-                    tw = weight_id_rows.w.values
-                    tgid = weight_id_rows.grid_ids.values
-                    # tmask, tgid, tw = getweights(index[i], gid, hid, w)
-
-                    d_tmax[i] = getaverage(d_flt_tmax[tgid] - 273.15, tw)
-                    d_tmin[i] = getaverage(d_flt_tmin[tgid] - 273.15, tw)
-                    d_ppt[i] = getaverage(d_flt_ppt[tgid], tw)
-                    d_rhmax[i] = getaverage(d_flt_rhmax[tgid], tw)
-                    d_rhmin[i] = getaverage(d_flt_rhmin[tgid], tw)
-                    d_ws[i] = getaverage(d_flt_ws[tgid], tw)
-
-                    if 'srad' in self.vars:
-                        d_srad[i] = getaverage(d_flt_srad[tgid], tw)
-                else:
-                    try:
-                        weight_id_rows = self.unique_hru_ids.get_group(tindex[i])
-                        tw = weight_id_rows.w.values
-                        tgid = weight_id_rows.grid_ids.values
-                        # if one var is nan all are nan. getaverage returns nan if 1 value is nan
-                        # np_get_wval return nan if all values are nan otherwise returns the
-                        # weighted masked val.  So assumption here is return a value for partially
-                        # weighted HRUs
-                        nanvar = False
-                        if np.isnan(getaverage(d_flt_tmax[tgid], tw)):
-                            nanvar = True
-
-                        if nanvar:
-                            d_tmax[i] = np_get_wval(d_flt_tmax[tgid] - 273.15, tw, tindex[i])
-                            d_tmin[i] = np_get_wval(d_flt_tmin[tgid] - 273.15, tw, tindex[i])
-                            d_ppt[i] = np_get_wval(d_flt_ppt[tgid], tw, tindex[i])
-                            d_rhmax[i] = np_get_wval(d_flt_rhmax[tgid], tw, tindex[i])
-                            d_rhmin[i] = np_get_wval(d_flt_rhmin[tgid], tw, tindex[i])
-                            d_ws[i] = np_get_wval(d_flt_ws[tgid], tw, tindex[i])
-
-                        else:
-                            d_tmax[i] = getaverage(d_flt_tmax[tgid] - 273.15, tw)
-                            d_tmin[i] = getaverage(d_flt_tmin[tgid] - 273.15, tw)
-                            d_ppt[i] = getaverage(d_flt_ppt[tgid], tw)
-                            d_rhmax[i] = getaverage(d_flt_rhmax[tgid], tw)
-                            d_rhmin[i] = getaverage(d_flt_rhmin[tgid], tw)
-                            d_ws[i] = getaverage(d_flt_ws[tgid], tw)
-
-                        if 'srad' in self.vars:
-                            if nanvar:
-                                d_srad[i] = np_get_wval(d_flt_srad[tgid], tgid, tw, tindex[i])
-                            else:
-                                d_srad[i] = getaverage(d_flt_srad[tgid], tw)
-                    except KeyError:
-                        # This except block protects against HRUs that are completely
-                        # outside the footprint of Gridmet.  If so, they will have no value
-                        # in the weights file and so return default value.
-                        d_tmax[i] = netCDF4.default_fillvals['f8']
-                        d_tmin[i] = netCDF4.default_fillvals['f8']
-                        d_ppt[i] = netCDF4.default_fillvals['f8']
-                        d_rhmax[i] = netCDF4.default_fillvals['f8']
-                        d_rhmin[i] = netCDF4.default_fillvals['f8']
-                        d_ws[i] = netCDF4.default_fillvals['f8']
-                        if 'srad' in self.vars:
-                            d_srad[i] = netCDF4.default_fillvals['f8']
-
-                    if i % 10000 == 0:
-                        print(f'    Processing hru {i}', flush=True)
-
-
-            self.np_tmax[day, :] = d_tmax[:]
-            self.np_tmin[day, :] = d_tmin[:]
-            self.np_ppt[day, :] = d_ppt[:]
-            self.np_rhmax[day, :] = d_rhmax[:]
-            self.np_rhmin[day, :] = d_rhmin[:]
-            self.np_ws[day, :] = d_ws[:]
-            if 'srad' in self.vars:
-                self.np_srad[day, :] = d_srad[:]
-
-        # self.dstmax.close()
+        # The mapped arrays are backed by temporary files when they would not comfortably fit
+        # in memory, i.e. conus scale hru's over multi-decade periods.
+        shape = (self.numdays, self.num_hru)
+        nbytes = len(self.vars) * self.numdays * self.num_hru * np.dtype(np.float32).itemsize
+        if nbytes > MEMMAP_NBYTES:
+            self.np_tmpdir = TemporaryDirectory(dir=self.optpath)
+            print(f'mapped climate data backed by files in {self.np_tmpdir.name}', flush=True)
+
+        def getarray(var):
+            if self.np_tmpdir is None:
+                return np.empty(shape, dtype=np.float32)
+            return np.memmap(Path(self.np_tmpdir.name) / f'{var}.f32', dtype=np.float32, mode='w+', shape=shape)
+
+        def mapvar(var):
+            # map NDAYS_CHUNK days at a time, reshaping the (day, lat, lon) cube to (day, cell) which
+            # is a view of the c-contiguous cube.  The values are mapped as float32, matching the
+            # output netcdf variables.
+            tstart = perf_counter()
+            tvar = self.ds[VAR_META[var]['gm']]
+            wavg = getarray(var)
+            for d0 in range(0, self.numdays, NDAYS_CHUNK):
+                d1 = min(d0 + NDAYS_CHUNK, self.numdays)
+                flt = tvar[d0:d1].values.reshape(d1 - d0, -1).astype(np.float32, copy=False)
+                wavg[d0:d1] = np_get_wvals(wmat, flt, self.partial, VAR_META[var]['offset'])
+            print(f'    Processed {var}: {self.numdays} days in {perf_counter() - tstart:.2f} s', flush=True)
+            return var, wavg
+
+        # The vars are independent and scipy's sparse products release the GIL, so the vars are
+        # mapped concurrently.  Each thread holds one block of up to NDAYS_CHUNK days of a var at a
+        # time, about 20 bytes per cell and day for the float64 read, its float32 copy, the nan
+        # mask and the masked copy of partial mapping.  The peak is threads x block size, so the
+        # threads are limited to keep it within MAP_NBYTES.
+        block_nbytes = min(self.numdays, NDAYS_CHUNK) * self.latshape * self.lonshape * 20
+        max_workers = max(1, min(len(self.vars), os.cpu_count() or 1, MAP_NBYTES // block_nbytes))
+        print(f'Processing {self.numdays} days of {self.vars} with {max_workers} threads', flush=True)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            self.np_arrays = dict(executor.map(mapvar, self.vars))
+
+        # self.ds.close()
 
     def finalize(self):
         print(Path.cwd(), flush=True)
@@ -433,11 +332,9 @@ class FpoNHM:
             self.optpath / (self.fileprefix + 'climate_' + str(self.end_date.strftime('%Y_%m_%d')) + '.nc'),
             mode='w', format='NETCDF4_CLASSIC')
 
-        def getxy(pt):
-            return pt.x, pt.y
-
         centroidseries = self.gdf1.geometry.centroid
-        tlon, tlat = [list(t) for t in zip(*map(getxy, centroidseries))]
+        tlon = centroidseries.x.to_numpy(dtype=np.float32)
+        tlat = centroidseries.y.to_numpy(dtype=np.float32)
 
         # Global Attributes
         ncfile.Conventions = 'CF-1.8'
@@ -448,18 +345,22 @@ class FpoNHM:
         # Create dimensions
 
         hruid_dim = ncfile.createDimension('hruid', size=sp_dim)  # hru_id
-        time_dim = ncfile.createDimension('time', size=None)  # unlimited axis (can be appended to).
+        time_dim = ncfile.createDimension('time', size=self.numdays)
 
         for dim in ncfile.dimensions.items():
             print(dim, flush=True)
 
+        # compress the climate variables and chunk them for reading hru time series
+        comp = dict(zlib=True, complevel=4, shuffle=True,
+                    chunksizes=(min(self.numdays, NDAYS_CHUNK), min(sp_dim, 4096)))
+
         # Create Variables
         time = ncfile.createVariable('time', 'f4', ('time',))
         time.long_name = 'time'
         time.standard_name = 'time'
         time.units = 'days since ' + self.str_start
         time.calendar = 'standard'
-        time[:] = arange(0, self.numdays, dtype=np.float)
+        time[:] = arange(0, self.numdays, dtype=np.float32)
 
         hru = ncfile.createVariable('hruid', 'i', ('hruid',))
         hru.cf_role = 'timeseries_id'
@@ -478,72 +379,41 @@ class FpoNHM:
         lon.standard_name = 'hru_longitude'
         lon[:] = tlon
 
+        # The climate vars are stored as int16 with scale_factor and add_offset, readers unpack them
+        # to float32.  The vars are written NDAYS_CHUNK days at a time, matching the chunks of the
+        # netcdf vars.
+        def createpacked(name, scale_factor):
+            ncvar = ncfile.createVariable(name, 'i2', ('time', 'hruid'), fill_value=default_fillvals['i2'], **comp)
+            ncvar.scale_factor = np.float32(scale_factor)
+            ncvar.add_offset = np.float32(0.0)
+            ncvar.set_auto_maskandscale(False)
+            return ncvar
+
         for var in self.vars:
-            if var == 'tmax':
-                tmax = ncfile.createVariable('tmax', dtype(float32).char, ('time', 'hruid'))
-                tmax.long_name = 'Maximum daily air temperature'
-                tmax.units = 'degree_Celsius'
-                tmax.standard_name = 'maximum_daily_air_temperature'
-                tmax.fill_value = default_fillvals['f8']
-                tmax[:, :] = self.np_tmax[:, :]
-
-            elif var == 'tmin':
-                tmin = ncfile.createVariable('tmin', dtype(float32).char, ('time', 'hruid'))
-                tmin.long_name = 'Minimum daily air temperature'
-                tmin.units = 'degree_Celsius'
-                tmin.standard_name = 'minimum_daily_air_temperature'
-                tmin.fill_value = default_fillvals['f8']
-                tmin[:, :] = self.np_tmin[:, :]
-
-            elif var == 'ppt':
-                prcp = ncfile.createVariable('prcp', dtype(float32).char, ('time', 'hruid'))
-                prcp.long_name = 'Daily Accumulated Precipitation'
-                prcp.units = 'mm'
-                prcp.standard_name = 'prcp'
-                prcp.fill_value = default_fillvals['f8']
-                prcp[:, :] = self.np_ppt[:, :]
-
-            elif var == 'rhmax':
-                rhmax = ncfile.createVariable('rhmax', dtype(float32).char, ('time', 'hruid'))
-                rhmax.long_name = 'Daily Maximum Relative Humidity'
-                rhmax.units = 'percent'
-                rhmax.standard_name = 'rhmax'
-                rhmax.fill_value = default_fillvals['f8']
-                rhmax[:, :] = self.np_rhmax[:, :]
-
-            elif var == 'rhmin':
-                rhmin = ncfile.createVariable('rhmin', dtype(float32).char, ('time', 'hruid'))
-                rhmin.long_name = 'Daily Maximum Relative Humidity'
-                rhmin.units = 'percent'
-                rhmin.standard_name = 'rhmin'
-                rhmin.fill_value = default_fillvals['f8']
-                rhmin[:, :] = self.np_rhmin[:, :]
-
-            elif var == 'ws':
-                ws = ncfile.createVariable('ws', dtype(float32).char, ('time', 'hruid'))
-                ws.long_name = 'Daily Mean Wind Speed'
-                ws.units = 'm/s'
-                ws.standard_name = 'ws'
-                ws.fill_value = default_fillvals['f8']
-                ws[:, :] = self.np_ws[:, :]
-
-            elif var == 'srad':
-                srad = ncfile.createVariable('srad', dtype(float32).char, ('time', 'hruid'))
-                srad.long_name = 'surface_downwelling_shortwave_flux_in_air'
-                srad.units = 'W m-2'
-                srad.standard_name = 'srad'
-                srad.fill_value = default_fillvals['f8']
-                srad[:, :] = self.np_srad[:, :]
-
-        hum = ncfile.createVariable('humidity', dtype(float32).char, ('time', 'hruid'))
+            meta = VAR_META[var]
+            ncvar = createpacked(meta['nc_name'], meta['scale_factor'])
+            ncvar.long_name = meta['long_name']
+            ncvar.units = meta['units']
+            ncvar.standard_name = meta['standard_name']
+            for d0 in range(0, self.numdays, NDAYS_CHUNK):
+                ncvar[d0:d0 + NDAYS_CHUNK, :] = pack_int16(self.np_arrays[var][d0:d0 + NDAYS_CHUNK],
+                                                           meta['scale_factor'])
+
+        hum = createpacked('humidity', 0.01)
         hum.long_name = 'Daily mean relative humidity'
         hum.units = 'percent'
         hum.standard_name = 'rhavg'
-        hum.fill_value = default_fillvals['f8']
-        hum[:, :] = (self.np_rhmax[:, :] + self.np_rhmin[:, :])/2.0
+        for d0 in range(0, self.numdays, NDAYS_CHUNK):
+            hum[d0:d0 + NDAYS_CHUNK, :] = pack_int16((self.np_arrays['rhmax'][d0:d0 + NDAYS_CHUNK] +
+                                                      self.np_arrays['rhmin'][d0:d0 + NDAYS_CHUNK])/2.0, 0.01)
 
         ncfile.close()
         print("dataset is closed", flush=True)
 
+        if self.np_tmpdir is not None:
+            self.np_arrays = None
+            self.np_tmpdir.cleanup()
+            self.np_tmpdir = None
+
     def setnumdays(self, num_d):
         self.numdays = num_d
@@ -1,4 +1,9 @@
+import os
+import tempfile
+import zipfile
 import numpy as np
+import pandas as pd
+import scipy.sparse as sp
 import datetime as dt
 from numpy.ma import masked
 import traceback
@@ -7,6 +12,37 @@ from numpy import average
 from netCDF4 import default_fillvals
 
 
+# Metadata for each climate var:
+#   gm, url: GridMet variable name and NetcdfSubset url of the aggregate storing it
+#   offset: added to the mapped values
+#   nc_name, units, long_name, standard_name: output netcdf variable
+#   scale_factor: precision of the int16 packed values in the output file
+GM_URL = 'http://thredds.northwestknowledge.net:8080/thredds/ncss/'
+VAR_META = {
+    'tmax': {'gm': 'daily_maximum_temperature', 'url': GM_URL + 'agg_met_tmmx_1979_CurrentYear_CONUS.nc',
+             'nc_name': 'tmax', 'offset': -273.15, 'scale_factor': 0.01, 'units': 'degree_Celsius',
+             'long_name': 'Maximum daily air temperature', 'standard_name': 'maximum_daily_air_temperature'},
+    'tmin': {'gm': 'daily_minimum_temperature', 'url': GM_URL + 'agg_met_tmmn_1979_CurrentYear_CONUS.nc',
+             'nc_name': 'tmin', 'offset': -273.15, 'scale_factor': 0.01, 'units': 'degree_Celsius',
+             'long_name': 'Minimum daily air temperature', 'standard_name': 'minimum_daily_air_temperature'},
+    'ppt': {'gm': 'precipitation_amount', 'url': GM_URL + 'agg_met_pr_1979_CurrentYear_CONUS.nc',
+            'nc_name': 'prcp', 'offset': 0.0, 'scale_factor': 0.1, 'units': 'mm',
+            'long_name': 'Daily Accumulated Precipitation', 'standard_name': 'prcp'},
+    'rhmax': {'gm': 'daily_maximum_relative_humidity', 'url': GM_URL + 'grid/agg_met_rmax_1979_CurrentYear_CONUS.nc',
+              'nc_name': 'rhmax', 'offset': 0.0, 'scale_factor': 0.01, 'units': 'percent',
+              'long_name': 'Daily Maximum Relative Humidity', 'standard_name': 'rhmax'},
+    'rhmin': {'gm': 'daily_minimum_relative_humidity', 'url': GM_URL + 'grid/agg_met_rmin_1979_CurrentYear_CONUS.nc',
+              'nc_name': 'rhmin', 'offset': 0.0, 'scale_factor': 0.01, 'units': 'percent',
+              'long_name': 'Daily Minimum Relative Humidity', 'standard_name': 'rhmin'},
+    'ws': {'gm': 'daily_mean_wind_speed', 'url': GM_URL + 'grid/agg_met_vs_1979_CurrentYear_CONUS.nc',
+           'nc_name': 'ws', 'offset': 0.0, 'scale_factor': 0.01, 'units': 'm/s',
+           'long_name': 'Daily Mean Wind Speed', 'standard_name': 'ws'},
+    'srad': {'gm': 'daily_mean_shortwave_radiation_at_surface',
+             'url': GM_URL + 'grid/agg_met_srad_1979_CurrentYear_CONUS.nc',
+             'nc_name': 'srad', 'offset': 0.0, 'scale_factor': 0.1, 'units': 'W m-2',
+             'long_name': 'surface_downwelling_shortwave_flux_in_air', 'standard_name': 'srad'}}
+
+
 def getaverage(data, wghts):
     try:
         v_ave = average(data, weights=wghts)
@@ -41,6 +77,172 @@ def np_get_wval(ndata, wghts, hru_id=0):
         return tmp
 
 
+def read_wghts(wghts_file):
+    """
+    Returns the columns of the weights file
+    1) the first time a weights file is read its columns are saved to a .npz file next to it, later
+    runs load the .npz rather than parsing the csv.
+    2) the .npz stores the size and mtime of the csv it was built from and is rebuilt if either
+    differs from the current csv or the .npz can not be read.
+    :param wghts_file: pathlib.Path of the weights csv with columns grid_ids, hru id and w
+    :return: name of the hru id column, and arrays of hru ids, grid ids and weights
+    """
+    npz_file = wghts_file.with_suffix('.npz')
+    wstat = wghts_file.stat()
+    if npz_file.exists():
+        try:
+            with np.load(npz_file) as wf:
+                if wf['csv_size'] == wstat.st_size and wf['csv_mtime_ns'] == wstat.st_mtime_ns:
+                    return str(wf['wghts_id']), wf['hru_ids'], wf['grid_ids'], wf['w']
+        except (OSError, EOFError, ValueError, KeyError, zipfile.BadZipFile) as err:
+            print(f'weights cache {npz_file} not readable, reading {wghts_file}: {err}', flush=True)
+
+    wght_uofi = pd.read_csv(wghts_file)
+    # grab the hru_id from the weights file and use as identifier
+    wghts_id = wght_uofi.columns[1]
+    hru_ids = wght_uofi[wghts_id].values.astype(np.int64)
+    grid_ids = wght_uofi.grid_ids.values.astype(np.int32)
+    w = wght_uofi.w.values.astype(np.float32)
+    # write to a temporary file and move it into place so an interrupted write never leaves a
+    # truncated cache
+    tmp_name = None
+    try:
+        with tempfile.NamedTemporaryFile(dir=npz_file.parent, prefix=npz_file.stem, suffix='.tmp',
+                                         delete=False) as fh:
+            tmp_name = fh.name
+            np.savez(fh, wghts_id=wghts_id, hru_ids=hru_ids, grid_ids=grid_ids, w=w,
+                     csv_size=wstat.st_size, csv_mtime_ns=wstat.st_mtime_ns)
+        # NamedTemporaryFile creates the file 0600, give the cache the mode of a normally written file
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(tmp_name, 0o666 & ~umask)
+        os.replace(tmp_name, npz_file)
+    except OSError as err:
+        print(f'weights file not cached to {npz_file}: {err}', flush=True)
+        if tmp_name is not None and os.path.exists(tmp_name):
+            os.remove(tmp_name)
+    return wghts_id, hru_ids, grid_ids, w
+
+
+def get_wght_matrix(hru_index, hru_ids, grid_ids, wghts, ncells):
+    """
+    Returns the sparse weights matrix used to map gridded values to hru's
+    1) row i holds the weights of the grid cells intersecting the hru at position i of hru_index.
+    2) weights of hru_ids that are not in hru_index are dropped.
+    3) rows are normalized to sum to 1 so the product of the matrix with the flattened data
+    returns the weighted average.  hru's without weights have an empty row.
+    4) weights are stored as float32 so float32 data is mapped without upcasting.
+    :param hru_index: sorted int array of hru ids
+    :param hru_ids: int array of hru id for each weight
+    :param grid_ids: int array of flattened grid cell index for each weight
+    :param wghts: float array of weights
+    :param ncells: number of grid cells
+    :return: scipy.sparse csr matrix of shape (len(hru_index), ncells)
+    :raises ValueError: if a grid id is outside of the grid
+    """
+    num_hru = len(hru_index)
+    rows = np.searchsorted(hru_index, hru_ids)
+    inshp = rows < num_hru
+    inshp[inshp] = hru_index[rows[inshp]] == hru_ids[inshp]
+    rows = rows[inshp]
+    tgid = grid_ids[inshp]
+    if tgid.size and (tgid.min() < 0 or tgid.max() >= ncells):
+        raise ValueError(f'weights grid_ids must be in the range 0 to {ncells - 1}, '
+                         f'found {tgid.min()} to {tgid.max()}')
+    # the csr arrays are built directly from the weights sorted by row, weights files are
+    # usually already ordered by hru so the stable sort is cheap
+    order = np.argsort(rows, kind='stable')
+    counts = np.bincount(rows, minlength=num_hru)
+    row_sums = np.bincount(rows, weights=wghts[inshp], minlength=num_hru)
+    indptr = np.concatenate(([0], np.cumsum(counts)))
+    data = wghts[inshp][order] / np.repeat(np.where(row_sums == 0, 1.0, row_sums), counts)
+    data = data.astype(np.float32)
+    return sp.csr_matrix((data, tgid[order], indptr), shape=(num_hru, ncells))
+
+
+def np_get_wvals(wmat, ndata, partial=False, offset=0.0):
+    """
+    Returns weighted average of ndata for each hru (row) of wmat
+    1) ndata is the (day, cell) array of values, all days are mapped in one sparse matrix product.
+    2) if not partial a nan in any of the hru's cells returns nan, otherwise the nans are
+    masked and the weighted average of the remaining cells is returned.
+    3) offset is added to the weighted averages, i.e. -273.15 for Kelvin to Celsius.  This is applied
+    to the (day, hru) result rather than the larger (day, cell) data.
+    4) hru's with no weights, or where all values are nan, are assigned the default value.
+    :param wmat: sparse weights matrix from get_wght_matrix
+    :param ndata: float array (day, cell) of data values
+    :param partial: return values for partially mapped hru's
+    :param offset: value added to the weighted averages
+    :return: float array (day, hru) of weighted averages
+    """
+    flt = ndata.T
+    if not partial:
+        wavg = (wmat @ flt).T
+        wavg += offset
+        wavg[:, np.asarray(wmat.sum(axis=1)).ravel() == 0] = netCDF4.default_fillvals['f8']
+    else:
+        tnan = np.isnan(ndata)
+        cnan = tnan.any(axis=0)
+        if (tnan == cnan).all():
+            # The nan cells are the same every day, i.e. cells outside of conus, so their weights
+            # are removed from the matrix and the rows renormalized.  The data is then used
+            # without masking.
+            wvar = wmat.copy()
+            wvar.data[cnan[wvar.indices]] = 0.0
+            wvar.eliminate_zeros()
+            tw = np.asarray(wvar.sum(axis=1)).ravel()
+            wvar.data /= np.repeat(np.where(tw > 0, tw, 1.0), np.diff(wvar.indptr))
+            wavg = (wvar @ flt).T
+            wavg += offset
+            wavg[:, tw == 0] = netCDF4.default_fillvals['f8']
+        else:
+            # the nan mask buffer is reused for the valid cells and the division is done in place
+            tnan = tnan.T
+            wavg = (wmat @ np.where(tnan, 0.0, flt)).T
+            tw = (wmat @ np.logical_not(tnan, out=tnan).astype(flt.dtype)).T
+            tvalid = tw > 0
+            np.divide(wavg, tw, out=wavg, where=tvalid)
+            wavg += offset
+            wavg[~tvalid] = netCDF4.default_fillvals['f8']
+    return wavg
+
+
+def pack_int16(data, scale_factor, add_offset=0.0):
+    """
+    Returns data packed to int16 with the CF scale_factor and add_offset attributes
+    1) values are stored as round((data - add_offset) / scale_factor) and unpacked on read.
+    2) values that can not be represented, nan and the default float fill value, are set
+    to the default int16 fill value.
+    :param data: float array of data values
+    :param scale_factor: scale_factor attribute of the int16 variable
+    :param add_offset: add_offset attribute of the int16 variable
+    :return: int16 array of packed values
+    """
+    with np.errstate(over='ignore', invalid='ignore'):
+        packed = np.round((data - add_offset) / scale_factor)
+        missing = ~(np.abs(packed) < np.iinfo(np.int16).max)
+    packed[missing] = default_fillvals['i2']
+    return packed.astype(np.int16)
+
+
+def get_day_join(days):
+    """
+    Returns the xarray join used to merge files holding different variables on the same grid
+    1) files with the same days are merged without aligning coordinates, 'override'.
+    2) if Gridmet is not updated for all variables some files end early, then the days common to
+    all files are merged, 'inner'.
+    3) files starting on different days, or without days, can not be merged.
+    :param days: list of the day coordinate array of each file
+    :return: 'override' or 'inner'
+    :raises ValueError: if the files start on different days
+    """
+    if any(len(tday) == 0 or tday[0] != days[0][0] for tday in days):
+        raise ValueError('files start on different days')
+    if all(len(tday) == len(days[0]) and tday[-1] == days[0][-1] for tday in days):
+        return 'override'
+    return 'inner'
+
+
 def get_gm_url(type, dataset, numdays=None, startdate=None, enddate=None, ctype='GridMetSS'):
     """
     This helper function returns a url and payload to be used with requests
@@ -48,8 +250,8 @@ def get_gm_url(type, dataset, numdays=None, startdate=None, enddate=None, ctype=
     myfile = requests.get(url, params=payload)
 
     :param numdays: proceeding number of days to retrieve
-    :param dataset: datset to retrieve can be:
-        'tmax', 'tmin', 'ppt'
+    :param dataset: datset or list of datasets stored in the same aggregate to retrieve can be:
+        'tmax', 'tmin', 'ppt', 'rhmax', 'rhmin', 'ws', 'srad'
     :param ctype: Type of url to retrieve:
         'GridMet':
     :return: URL for retrieving GridMet subset data and payload of options
@@ -72,27 +274,15 @@ def get_gm_url(type, dataset, numdays=None, startdate=None, enddate=None, ctype=
     dsvar = None
     url = None
     if ctype == 'GridMetSS':  # extract data using NetcdfSubset service
-        if dataset == 'tmax':
-            dsvar = 'daily_maximum_temperature'
-            url = 'http://thredds.northwestknowledge.net:8080/thredds/ncss/agg_met_tmmx_1979_CurrentYear_CONUS.nc'
-        elif dataset == 'tmin':
-            dsvar = 'daily_minimum_temperature'
-            url = 'http://thredds.northwestknowledge.net:8080/thredds/ncss/agg_met_tmmn_1979_CurrentYear_CONUS.nc'
-        elif dataset == 'ppt':
-            dsvar = 'precipitation_amount'
-            url = 'http://thredds.northwestknowledge.net:8080/thredds/ncss/agg_met_pr_1979_CurrentYear_CONUS.nc'
-        elif dataset == 'rhmax':
-            dsvar = 'daily_maximum_relative_humidity'
-            url = 'http://thredds.northwestknowledge.net:8080/thredds/ncss/grid/agg_met_rmax_1979_CurrentYear_CONUS.nc'
-        elif dataset == 'rhmin':
-            dsvar = 'daily_minimum_relative_humidity'
-            url = 'http://thredds.northwestknowledge.net:8080/thredds/ncss/grid/agg_met_rmin_1979_CurrentYear_CONUS.nc'
-        elif dataset == 'ws':
-            dsvar = 'daily_mean_wind_speed'
-            url = 'http://thredds.northwestknowledge.net:8080/thredds/ncss/grid/agg_met_vs_1979_CurrentYear_CONUS.nc'
-        elif dataset == 'srad':
-            dsvar = 'daily_mean_shortwave_radiation_at_surface'
-            url = 'http://thredds.northwestknowledge.net:8080/thredds/ncss/grid/agg_met_srad_1979_CurrentYear_CONUS.nc'
+        # datasets stored in the same aggregate are retrieved in one request
+        datasets = [dataset] if isinstance(dataset, str) else list(dataset)
+        urls = {VAR_META[d]['url'] for d in datasets}
+        if len(urls) != 1:
+            raise ValueError(f'datasets {datasets} are not stored in the same GridMet aggregate')
+        url = urls.pop()
+        dsvar = [VAR_META[d]['gm'] for d in datasets]
+        if isinstance(dataset, str):
+            dsvar = dsvar[0]
 
         payload = {
             'var': dsvar,
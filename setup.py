@@ -10,7 +10,7 @@ with open('README.rst') as readme_file:
 with open('HISTORY.rst') as history_file:
     history = history_file.read()
 
-requirements = ['pandas', 'geopandas', 'numpy', 'xarray', 'netcdf4', 'requests', 'dask']
+requirements = ['pandas', 'geopandas', 'numpy', 'xarray', 'netcdf4', 'requests', 'dask', 'scipy']
 
 setup_requirements = [ ]
 
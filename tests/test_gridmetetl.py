@@ -3,12 +3,15 @@
 """Tests for `gridmetetl` package."""
 
 
+import datetime
+import os
 import pytest
 import numpy as np
 from netCDF4 import default_fillvals
 
-from gridmetetl import etl
-from gridmetetl.helper import getaverage, np_get_wval
+from gridmetetl import etl, helper
+from gridmetetl.helper import getaverage, np_get_wval, get_wght_matrix, np_get_wvals, get_gm_url, \
+    read_wghts, pack_int16, get_day_join
 
 
 def test_getaverage():
@@ -31,3 +34,117 @@ def test_np_get_wval():
     # test returns default value when array all nans
     assert np_get_wval(np.array([np.nan, np.nan]), np.array([1., 1.])) == default_fillvals['f8']
 
+
+def test_read_wghts(tmp_path, monkeypatch):
+    wghts_file = tmp_path / 'weights.csv'
+    npz_file = tmp_path / 'weights.npz'
+    wghts_file.write_text('grid_ids,hru_id_nat,w\n0,1,0.75\n1,1,0.25\n2,2,1.0\n')
+
+    def check_wghts(w_expected):
+        wghts_id, hru_ids, grid_ids, w = read_wghts(wghts_file)
+        assert wghts_id == 'hru_id_nat'
+        np.testing.assert_array_equal(hru_ids, [1, 1, 2])
+        np.testing.assert_array_equal(grid_ids, [0, 1, 2])
+        np.testing.assert_allclose(w, w_expected)
+
+    check_wghts([0.75, 0.25, 1.0])
+    assert npz_file.exists()
+    assert list(tmp_path.glob('*.tmp')) == []
+    umask = os.umask(0)
+    os.umask(umask)
+    assert npz_file.stat().st_mode & 0o777 == 0o666 & ~umask
+
+    # test the cache is loaded without parsing the csv
+    with monkeypatch.context() as m:
+        m.setattr(helper.pd, 'read_csv', None)
+        check_wghts([0.75, 0.25, 1.0])
+
+    # test a replaced csv with an older mtime is read rather than the cache
+    wghts_file.write_text('grid_ids,hru_id_nat,w\n0,1,0.5\n1,1,0.5\n2,2,1.0\n')
+    os.utime(wghts_file, (npz_file.stat().st_mtime - 10,) * 2)
+    check_wghts([0.5, 0.5, 1.0])
+
+    # test a truncated cache falls back to the csv and is rebuilt
+    npz_file.write_bytes(npz_file.read_bytes()[:20])
+    check_wghts([0.5, 0.5, 1.0])
+    with monkeypatch.context() as m:
+        m.setattr(helper.pd, 'read_csv', None)
+        check_wghts([0.5, 0.5, 1.0])
+
+    # test hru ids too large for int32 are kept
+    wghts_file.write_text('grid_ids,huc12,w\n0,180101010101,1.0\n')
+    wghts_id, hru_ids, grid_ids, w = read_wghts(wghts_file)
+    assert wghts_id == 'huc12'
+    np.testing.assert_array_equal(hru_ids, [180101010101])
+
+
+def test_get_wght_matrix():
+    wmat = get_wght_matrix(np.array([1, 2]), np.array([2, 1, 1]), np.array([2, 0, 1]),
+                           np.array([1.0, 3.0, 1.0]), 3)
+    assert wmat.shape == (2, 3)
+    np.testing.assert_allclose(wmat.toarray(), [[0.75, 0.25, 0.0], [0.0, 0.0, 1.0]])
+    # test grid ids outside of the grid raise
+    with pytest.raises(ValueError):
+        get_wght_matrix(np.array([1]), np.array([1, 1]), np.array([0, 50]), np.array([1.0, 1.0]), 3)
+    with pytest.raises(ValueError):
+        get_wght_matrix(np.array([1]), np.array([1]), np.array([-1]), np.array([1.0]), 3)
+
+
+def test_np_get_wvals():
+    # hru 3 has no weights and the weight for hru 9 is not in the hru index
+    wmat = get_wght_matrix(np.array([1, 2, 3]), np.array([1, 1, 2, 9]), np.array([0, 1, 2, 0]),
+                           np.array([0.75, 0.25, 2.0, 1.0]), 3)
+    data = np.array([[4., 2., 1.], [np.nan, 2., 1.], [np.nan, np.nan, np.nan]])
+    wavg = np_get_wvals(wmat, data)
+    np.testing.assert_allclose(wavg[0], [3.5, 1.0, default_fillvals['f8']])
+    # test that nan in one of the hru cells returns nan
+    assert np.isnan(wavg[1, 0])
+    assert wavg[1, 1] == 1.0
+    # test partial returns weighted average of non nan cells and default value when all nans
+    wavg = np_get_wvals(wmat, data, partial=True)
+    np.testing.assert_allclose(wavg[0], [3.5, 1.0, default_fillvals['f8']])
+    np.testing.assert_allclose(wavg[1], [2.0, 1.0, default_fillvals['f8']])
+    np.testing.assert_allclose(wavg[2], [default_fillvals['f8']] * 3)
+    # test partial with nans in the same cells every day
+    wavg = np_get_wvals(wmat, np.array([[np.nan, 2., 1.], [np.nan, 4., 1.]]), partial=True)
+    np.testing.assert_allclose(wavg[:, 0], [2.0, 4.0])
+    wavg = np_get_wvals(wmat, np.array([[np.nan, np.nan, 1.0]] * 2), partial=True)
+    np.testing.assert_allclose(wavg, [[default_fillvals['f8'], 1.0, default_fillvals['f8']]] * 2)
+    # test offset is applied to the weighted average but not the default value
+    wavg = np_get_wvals(wmat, data + 273.15, offset=-273.15)
+    np.testing.assert_allclose(wavg[0], [3.5, 1.0, default_fillvals['f8']])
+
+
+def test_get_gm_url():
+    start = datetime.datetime(2020, 1, 1)
+    end = datetime.datetime(2020, 1, 31)
+    str_start, url, payload = get_gm_url('date', 'tmax', startdate=start, enddate=end)
+    assert str_start == '2020-01-01 00:00:00'
+    assert url.endswith('agg_met_tmmx_1979_CurrentYear_CONUS.nc')
+    assert payload['var'] == 'daily_maximum_temperature'
+    assert payload['time_end'] == '2020-01-31T00:00:00Z'
+    # test list of datasets returns list of vars and raises if not in the same aggregate
+    _, _, payload = get_gm_url('date', ['tmax'], startdate=start, enddate=end)
+    assert payload['var'] == ['daily_maximum_temperature']
+    with pytest.raises(ValueError):
+        get_gm_url('date', ['tmax', 'tmin'], startdate=start, enddate=end)
+
+
+def test_pack_int16():
+    data = np.array([12.34, -2.0, 0.004, np.nan, default_fillvals['f8']], dtype=np.float32)
+    packed = pack_int16(data, 0.01)
+    assert packed.dtype == np.int16
+    np.testing.assert_array_equal(packed, [1234, -200, 0, default_fillvals['i2'], default_fillvals['i2']])
+    np.testing.assert_array_equal(pack_int16(np.array([10.0, 1000.0]), 0.1, add_offset=10.0), [0, 9900])
+
+
+def test_get_day_join():
+    days = np.arange('2020-01-01', '2020-01-11', dtype='datetime64[D]')
+    assert get_day_join([days, days.copy(), days.copy()]) == 'override'
+    # test files ending early are merged on their common days
+    assert get_day_join([days, days[:-1], days]) == 'inner'
+    # test files with the same number of days starting on different days raise
+    with pytest.raises(ValueError):
+        get_day_join([days, days + 1])
+    with pytest.raises(ValueError):
+        get_day_join([days, days[:0]])